@@ -1,14 +1,26 @@
 import asyncio
 
 from fastapi import APIRouter
+from fastapi.responses import JSONResponse, ORJSONResponse
 
 from lnbits.db import Database
 from lnbits.helpers import template_renderer
 from lnbits.tasks import catch_everything_and_restart
 
+try:
+    from orjson import loads as json_loads
+
+    json_response_class = ORJSONResponse
+except ImportError:  # orjson is optional, fall back to the stdlib json module
+    from json import loads as json_loads
+
+    json_response_class = JSONResponse
+
 db = Database("ext_tpos")
 
-tpos_ext: APIRouter = APIRouter(prefix="/tpos", tags=["TPoS"])
+tpos_ext: APIRouter = APIRouter(
+    prefix="/tpos", tags=["TPoS"], default_response_class=json_response_class
+)
 scheduled_tasks: list[asyncio.Task] = []
 
 tpos_static_files = [
@@ -1,14 +1,62 @@
-from typing import List, Optional, Union
+import asyncio
+from sqlite3 import sqlite_version_info
+from time import monotonic
+from typing import Dict, List, Optional, Set, Union
 
+from lnbits.db import SQLITE
 from lnbits.helpers import urlsafe_short_hash
 
 from . import db
+from .cache import TTLCache
 from .models import CreateTposData, TPoS
 
 
+_tpos_cache = TTLCache(maxsize=1024, ttl=60)
+_TPOS_FIELDS = tuple(TPoS.__fields__)
+# RETURNING needs SQLite 3.35+, postgres and cockroach always have it
+_RETURNING = db.type != SQLITE or sqlite_version_info >= (3, 35)
+# ids of ATM-enabled tposs, reloaded as often as `_tpos_cache` expires so
+# changes made by other workers are picked up
+_atm_tposs: Optional[Set[str]] = None
+_atm_expires = 0.0
+_atm_lock = asyncio.Lock()
+# writes made while the set is reloading, replayed onto the fresh snapshot
+_atm_pending: Optional[Dict[str, bool]] = None
+
+
+def _track_atm(tpos_id: str, enabled: bool) -> None:
+    if _atm_pending is not None:
+        _atm_pending[tpos_id] = enabled
+    if _atm_tposs is None:
+        return
+    if enabled:
+        _atm_tposs.add(tpos_id)
+    else:
+        _atm_tposs.discard(tpos_id)
+
+
+async def _write_tpos(tpos_id: str, query: str, values: tuple) -> Optional[TPoS]:
+    """
+    Run an INSERT/UPDATE for a single tpos and return the stored row,
+    in the same round-trip where the database supports RETURNING.
+    """
+    _tpos_cache.pop(tpos_id)
+    if not _RETURNING:
+        await db.execute(query, values)
+        return await get_tpos(tpos_id)
+
+    row = await db.fetchone(f"{query} RETURNING *", values)
+    if not row:
+        return None
+    tpos = TPoS(**row)
+    _tpos_cache.set(tpos_id, tpos)
+    return tpos
+
+
 async def create_tpos(wallet_id: str, data: CreateTposData) -> TPoS:
     tpos_id = urlsafe_short_hash()
-    await db.execute(
+    tpos = await _write_tpos(
+        tpos_id,
         """
         INSERT INTO tpos.tposs (id, wallet, name, currency, tip_options, tip_wallet, atm)
         VALUES (?, ?, ?, ?, ?, ?, ?)
@@ -23,38 +71,84 @@ async def create_tpos(wallet_id: str, data: CreateTposData) -> TPoS:
             data.atm
         ),
     )
-
-    tpos = await get_tpos(tpos_id)
     assert tpos, "Newly created tpos couldn't be retrieved"
+    _track_atm(tpos.id, bool(tpos.atm))
     return tpos
 
 
-async def update_tpos(tpos_id: str, **kwargs) -> TPoS:
+async def update_tpos(tpos_id: str, **kwargs) -> Optional[TPoS]:
     q = ", ".join([f"{field[0]} = ?" for field in kwargs.items()])
-    await db.execute(
-        f"UPDATE tpos.tposs SET {q} WHERE id = ?", (*kwargs.values(), tpos_id)
+    tpos = await _write_tpos(
+        tpos_id,
+        f"UPDATE tpos.tposs SET {q} WHERE id = ?",
+        (*kwargs.values(), tpos_id),
     )
-    tpos = await get_tpos(tpos_id)
-    assert tpos, "Newly updated tpos couldn't be retrieved"
+    if tpos:
+        _track_atm(tpos.id, bool(tpos.atm))
     return tpos
 
 
 async def get_tpos(tpos_id: str) -> Optional[TPoS]:
+    tpos = _tpos_cache.get(tpos_id)
+    if tpos:
+        return tpos
     row = await db.fetchone("SELECT * FROM tpos.tposs WHERE id = ?", (tpos_id,))
-    return TPoS(**row) if row else None
+    if not row:
+        return None
+    tpos = TPoS(**row)
+    _tpos_cache.set(tpos_id, tpos)
+    return tpos
+
+
+async def _load_atm_tposs() -> None:
+    global _atm_tposs, _atm_expires, _atm_pending
+    _atm_pending = {}
+    try:
+        rows = await db.fetchall("SELECT id FROM tpos.tposs WHERE atm")
+        atm_tposs = {row["id"] for row in rows}
+        for tpos_id, enabled in _atm_pending.items():
+            if enabled:
+                atm_tposs.add(tpos_id)
+            else:
+                atm_tposs.discard(tpos_id)
+    finally:
+        _atm_pending = None
+    _atm_tposs = atm_tposs
+    _atm_expires = monotonic() + _tpos_cache.ttl
 
 
-async def get_tposs(wallet_ids: Union[str, List[str]]) -> List[TPoS]:
+async def is_atm_enabled(tpos_id: str) -> bool:
+    if _atm_tposs is None or _atm_expires < monotonic():
+        async with _atm_lock:
+            if _atm_tposs is None or _atm_expires < monotonic():
+                await _load_atm_tposs()
+    return _atm_tposs is not None and tpos_id in _atm_tposs
+
+
+async def get_tposs_raw(wallet_ids: Union[str, List[str]]) -> List[dict]:
+    """
+    TPoS rows for `wallet_ids` as plain dicts, for read-only listings.
+    """
     if isinstance(wallet_ids, str):
         wallet_ids = [wallet_ids]
 
     q = ",".join(["?"] * len(wallet_ids))
     rows = await db.fetchall(
-        f"SELECT * FROM tpos.tposs WHERE wallet IN ({q})", (*wallet_ids,)
+        f"""
+        SELECT {", ".join(_TPOS_FIELDS)}
+        FROM tpos.tposs WHERE wallet IN ({q})
+        """,
+        (*wallet_ids,),
     )
 
-    return [TPoS(**row) for row in rows]
+    # sqlite stores booleans as integers
+    return [
+        {**row, "atm": None if row["atm"] is None else bool(row["atm"])}
+        for row in rows
+    ]
 
 
 async def delete_tpos(tpos_id: str) -> None:
     await db.execute("DELETE FROM tpos.tposs WHERE id = ?", (tpos_id,))
+    _tpos_cache.pop(tpos_id)
+    _track_atm(tpos_id, False)
@@ -1,4 +1,9 @@
+import asyncio
+import re
+from contextlib import suppress
 from http import HTTPStatus
+from operator import itemgetter
+from typing import Optional, Tuple
 
 import httpx
 from fastapi import Depends, Query
@@ -7,7 +12,6 @@ from loguru import logger
 from starlette.exceptions import HTTPException
 
 from lnbits.core.crud import get_latest_payments_by_extension, get_user
-from lnbits.core.models import Payment
 from lnbits.core.services import create_invoice, pay_invoice
 from lnbits.core.views.api import api_payment
 from lnbits.decorators import (
@@ -18,9 +22,58 @@ from lnbits.decorators import (
 )
 from lnbits.utils.exchange_rates import get_fiat_rate_satoshis
 
-from . import scheduled_tasks, tpos_ext
-from .crud import create_tpos, delete_tpos, get_tpos, get_tposs, update_tpos
-from .models import CreateTposData, PayLnurlWData
+from . import json_loads, json_response_class, scheduled_tasks, tpos_ext
+from .cache import TTLCache
+from .crud import (
+    create_tpos,
+    delete_tpos,
+    get_tpos,
+    get_tposs_raw,
+    is_atm_enabled,
+    update_tpos,
+)
+from .models import CreateTposData, PayLnurlWData, TPoS
+
+_HEADERS = {"user-agent": "lnbits/tpos"}
+_HTTP: Optional[httpx.AsyncClient] = None
+# keep outbound LNURL calls below the pool size so they never queue inside httpx
+_LNURL_SEM = asyncio.Semaphore(50)
+
+_fiat_rates = TTLCache(maxsize=128, ttl=30)
+# LNURL-pay metadata by pay link, only the callback GET has to hit the network
+_lnurl_meta = TTLCache(maxsize=1024, ttl=60)
+
+_SCHEME_RE = re.compile(r"^(?:lnurlw://|lightning://|lightning:)", re.IGNORECASE)
+# fields read from LNURL responses once the tag has been checked
+_GET_PAY = itemgetter("minSendable", "maxSendable", "callback")
+_GET_WITHDRAW = itemgetter("callback", "k1")
+
+
+def _http() -> httpx.AsyncClient:
+    """
+    Shared LNURL client, (re)created on first use after startup or api_stop.
+    """
+    global _HTTP
+    if _HTTP is None or _HTTP.is_closed:
+        _HTTP = httpx.AsyncClient(
+            headers=_HEADERS,
+            timeout=httpx.Timeout(10.0),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        )
+    return _HTTP
+
+
+def _fail(detail) -> dict:
+    return {"success": False, "detail": detail}
+
+
+async def get_tpos_or_404(tpos_id: str) -> TPoS:
+    tpos = await get_tpos(tpos_id)
+    if not tpos:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="TPoS does not exist."
+        )
+    return tpos
 
 
 @tpos_ext.get("/api/v1/tposs", status_code=HTTPStatus.OK)
@@ -32,7 +85,7 @@ async def api_tposs(
         user = await get_user(wallet.wallet.user)
         wallet_ids = user.wallet_ids if user else []
 
-    return [tpos.dict() for tpos in await get_tposs(wallet_ids)]
+    return await get_tposs_raw(wallet_ids)
 
 
 @tpos_ext.post("/api/v1/tposs", status_code=HTTPStatus.CREATED)
@@ -46,64 +99,50 @@ async def api_tpos_create(
 @tpos_ext.put("/api/v1/tposs/{tpos_id}")
 async def api_tpos_update(
     data: CreateTposData,
-    tpos_id: str,
     wallet: WalletTypeInfo = Depends(require_admin_key),
+    tpos: TPoS = Depends(get_tpos_or_404),
 ):
-    if not tpos_id:
+    if wallet.wallet.id != tpos.wallet:
+        raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="Not your TPoS.")
+    tpos = await update_tpos(tpos.id, **data.dict())
+    if tpos is None:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="TPoS does not exist."
         )
-    tpos = await get_tpos(tpos_id)
-    assert tpos, "TPoS couldn't be retrieved"
-
-    if wallet.wallet.id != tpos.wallet:
-        raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="Not your TPoS.")
-    tpos = await update_tpos(tpos_id, **data.dict())
     return tpos.dict()
 
 
 @tpos_ext.delete("/api/v1/tposs/{tpos_id}")
 async def api_tpos_delete(
-    tpos_id: str, wallet: WalletTypeInfo = Depends(require_admin_key)
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+    tpos: TPoS = Depends(get_tpos_or_404),
 ):
-    tpos = await get_tpos(tpos_id)
-
-    if not tpos:
-        raise HTTPException(
-            status_code=HTTPStatus.NOT_FOUND, detail="TPoS does not exist."
-        )
-
     if tpos.wallet != wallet.wallet.id:
         raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="Not your TPoS.")
 
-    await delete_tpos(tpos_id)
+    await delete_tpos(tpos.id)
     return "", HTTPStatus.NO_CONTENT
 
 
 @tpos_ext.post("/api/v1/tposs/{tpos_id}/invoices", status_code=HTTPStatus.CREATED)
 async def api_tpos_create_invoice(
-    tpos_id: str, amount: int = Query(..., ge=1), memo: str = "", tipAmount: int = 0
+    tpos: TPoS = Depends(get_tpos_or_404),
+    amount: int = Query(..., ge=1),
+    memo: str = "",
+    tipAmount: int = 0,
 ) -> dict:
-    tpos = await get_tpos(tpos_id)
-
-    if not tpos:
-        raise HTTPException(
-            status_code=HTTPStatus.NOT_FOUND, detail="TPoS does not exist."
-        )
-
-    if tipAmount > 0:
-        amount += tipAmount
+    total = amount + tipAmount if tipAmount > 0 else amount
 
     try:
         payment_hash, payment_request = await create_invoice(
             wallet_id=tpos.wallet,
-            amount=amount,
+            amount=total,
             memo=f"{memo} to {tpos.name}" if memo else f"{tpos.name}",
             extra={
                 "tag": "tpos",
                 "tipAmount": tipAmount,
-                "tposId": tpos_id,
-                "amount": amount - tipAmount if tipAmount else False,
+                "tposId": tpos.id,
+                "amount": amount if tipAmount else False,
             },
         )
     except Exception as e:
@@ -111,158 +150,168 @@ async def api_tpos_create_invoice(
 
     return {"payment_hash": payment_hash, "payment_request": payment_request}
 
+
+async def _get_pay_meta(pay_link: str) -> Tuple[Optional[tuple], Optional[str]]:
+    """
+    Fetch (or reuse) the LNURL-pay metadata behind `pay_link`.
+    Returns (minSendable, maxSendable, callback), or None and the reason
+    it couldn't be used.
+    """
+    meta = _lnurl_meta.get(pay_link)
+    if meta is not None:
+        return meta, None
+
+    async with _LNURL_SEM:
+        r = await _http().get(pay_link, follow_redirects=True)
+
+    if r.is_error:
+        return None, "Error loading"
+
+    resp = json_loads(r.content)
+
+    if resp["tag"] != "payRequest":
+        return None, "Wrong tag type"
+
+    meta = _GET_PAY(resp)
+    _lnurl_meta.set(pay_link, meta)
+    return meta, None
+
+
 @tpos_ext.post("/api/v1/tposs/{tpos_id}/atm", status_code=HTTPStatus.OK)
 async def api_tpos_make_atm(
     tpos_id: str, amount: int = Query(..., ge=1), memo: str = "", payLink: str = ""
 ) -> dict:
 
-    tpos = await get_tpos(tpos_id)
-
-    if not tpos:
-        raise HTTPException(
-            status_code=HTTPStatus.NOT_FOUND, detail="TPoS does not exist."
-        )
-    if (tpos.atm == 0 or tpos.atm == None):
-        return {"success": False, "detail": "ATM mode not allowed"} 
+    if not await is_atm_enabled(tpos_id):
+        return _fail("ATM mode not allowed")
 
-    payLink = payLink.replace("lnurlp://", "https://") # pointless lnurlp:// -> https://
+    if payLink.startswith("lnurlp://"): # pointless lnurlp:// -> https://
+        payLink = "https://" + payLink[len("lnurlp://"):]
 
-    async with httpx.AsyncClient() as client:
-        try:
-            headers = {"user-agent": f"lnbits/tpos"}
-            r = await client.get(payLink, follow_redirects=True, headers=headers)
+    # overlap the LNURL round-trip with the TPoS lookup when it misses the cache
+    meta_task = asyncio.create_task(_get_pay_meta(payLink))
 
-            if r.is_error:
-                return {"success": False, "detail": "Error loading"}
+    tpos = None
+    try:
+        tpos = await get_tpos_or_404(tpos_id)
+    finally:
+        if not tpos or not tpos.atm:
+            meta_task.cancel()
+            # retrieve the outcome so a failed fetch isn't logged as unretrieved
+            with suppress(BaseException):
+                await meta_task
 
-            resp = r.json()
+    if not tpos.atm:
+        return _fail("ATM mode not allowed")
 
-            amount = amount*1000 # convert to msats
+    try:
+        meta, error = await meta_task
+        if error:
+            return _fail(error)
+        min_sendable, max_sendable, callback = meta
 
-            if resp["tag"] != "payRequest":
-                return {"success": False, "detail": "Wrong tag type"}
+        amount = amount*1000 # convert to msats
 
-            if amount < resp["minSendable"]:
-                return {"success": False, "detail": "Amount too low"}
+        if amount < min_sendable:
+            return _fail("Amount too low")
 
-            if amount > resp["maxSendable"]:
-                return {"success": False, "detail": "Amount too high"}
+        if amount > max_sendable:
+            return _fail("Amount too high")
 
-            cb_res = await client.get(resp["callback"], follow_redirects=True, headers=headers, params={"amount": amount})
-            cb_resp = cb_res.json()
+        async with _LNURL_SEM:
+            cb_res = await _http().get(callback, follow_redirects=True, params={"amount": amount})
+        cb_resp = json_loads(cb_res.content)
 
-            if cb_res.is_error:
-                return {"success": False, "detail": "Error loading callback"}
+        if cb_res.is_error:
+            return _fail("Error loading callback")
 
-            try:
-                payment_hash = await pay_invoice(
-                    wallet_id=tpos.wallet,
-                    payment_request=cb_resp["pr"],
-                    description="ATM Withdrawal",
-                    extra={"tag": "tpos_atm", "tpos": tpos.id},
-                )
-                return {"success": True, "detail": "Payment successful", "payment_hash": payment_hash}
-            except Exception as exc:
-                return {"success": False, "reason": exc, "detail": f"Payment failed - {exc}"}
+        try:
+            payment_hash = await pay_invoice(
+                wallet_id=tpos.wallet,
+                payment_request=cb_resp["pr"],
+                description="ATM Withdrawal",
+                extra={"tag": "tpos_atm", "tpos": tpos.id},
+            )
+            return {"success": True, "detail": "Payment successful", "payment_hash": payment_hash}
+        except Exception as exc:
+            return {"success": False, "reason": exc, "detail": f"Payment failed - {exc}"}
 
-        except Exception as e:
-            raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR, detail=str(e))
 
 @tpos_ext.get("/api/v1/tposs/{tpos_id}/invoices")
 async def api_tpos_get_latest_invoices(tpos_id: str):
     try:
-        payments = [
-            Payment.from_row(row)
-            for row in await get_latest_payments_by_extension(
-                ext_name="tpos", ext_id=tpos_id
-            )
-        ]
+        rows = await get_latest_payments_by_extension(ext_name="tpos", ext_id=tpos_id)
 
     except Exception as e:
         raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR, detail=str(e))
 
-    return [
-        {
-            "checking_id": payment.checking_id,
-            "amount": payment.amount,
-            "time": payment.time,
-            "pending": payment.pending,
-        }
-        for payment in payments
-    ]
+    # already JSON-safe, so skip FastAPI's jsonable_encoder pass
+    return json_response_class(
+        [
+            {
+                "checking_id": row["checking_id"],
+                "amount": row["amount"],
+                "time": int(row["time"]),
+                "pending": bool(row["pending"]),
+            }
+            for row in rows
+        ]
+    )
 
 
 @tpos_ext.post(
-    "/api/v1/tposs/{tpos_id}/invoices/{payment_request}/pay", status_code=HTTPStatus.OK
+    "/api/v1/tposs/{tpos_id}/invoices/{payment_request}/pay",
+    status_code=HTTPStatus.OK,
+    dependencies=[Depends(get_tpos_or_404)],
 )
-async def api_tpos_pay_invoice(
-    lnurl_data: PayLnurlWData, payment_request: str, tpos_id: str
-):
-    tpos = await get_tpos(tpos_id)
-
-    if not tpos:
-        raise HTTPException(
-            status_code=HTTPStatus.NOT_FOUND, detail="TPoS does not exist."
-        )
-
-    lnurl = (
-        lnurl_data.lnurl.replace("lnurlw://", "")
-        .replace("lightning://", "")
-        .replace("LIGHTNING://", "")
-        .replace("lightning:", "")
-        .replace("LIGHTNING:", "")
-    )
+async def api_tpos_pay_invoice(lnurl_data: PayLnurlWData, payment_request: str):
+    lnurl = _SCHEME_RE.sub("", lnurl_data.lnurl, count=1)
 
     if lnurl.lower().startswith("lnurl"):
+        # a short bech32 decode, cheaper inline than a hop to the executor
         lnurl = decode_lnurl(lnurl)
     else:
         lnurl = "https://" + lnurl
 
-    async with httpx.AsyncClient() as client:
-        try:
-            headers = {"user-agent": f"lnbits/tpos"}
-            r = await client.get(lnurl, follow_redirects=True, headers=headers)
-            if r.is_error:
-                lnurl_response = {"success": False, "detail": "Error loading"}
-            else:
-                resp = r.json()
-                if resp["tag"] != "withdrawRequest":
-                    lnurl_response = {"success": False, "detail": "Wrong tag type"}
-                else:
-                    r2 = await client.get(
-                        resp["callback"],
-                        follow_redirects=True,
-                        headers=headers,
-                        params={
-                            "k1": resp["k1"],
-                            "pr": payment_request,
-                        },
-                    )
-                    resp2 = r2.json()
-                    if r2.is_error:
-                        lnurl_response = {
-                            "success": False,
-                            "detail": "Error loading callback",
-                        }
-                    elif resp2["status"] == "ERROR":
-                        lnurl_response = {"success": False, "detail": resp2["reason"]}
-                    else:
-                        lnurl_response = {"success": True, "detail": resp2}
-        except (httpx.ConnectError, httpx.RequestError):
-            lnurl_response = {"success": False, "detail": "Unexpected error occurred"}
-
-    return lnurl_response
+    try:
+        async with _LNURL_SEM:
+            r = await _http().get(lnurl, follow_redirects=True)
+        if r.is_error:
+            return _fail("Error loading")
+
+        resp = json_loads(r.content)
+        if resp["tag"] != "withdrawRequest":
+            return _fail("Wrong tag type")
+        callback, k1 = _GET_WITHDRAW(resp)
+
+        async with _LNURL_SEM:
+            r2 = await _http().get(
+                callback,
+                follow_redirects=True,
+                params={
+                    "k1": k1,
+                    "pr": payment_request,
+                },
+            )
+        resp2 = json_loads(r2.content)
+        if r2.is_error:
+            return _fail("Error loading callback")
+        if resp2["status"] == "ERROR":
+            return _fail(resp2["reason"])
+    except (httpx.ConnectError, httpx.RequestError):
+        return _fail("Unexpected error occurred")
+
+    return {"success": True, "detail": resp2}
 
 
 @tpos_ext.get(
-    "/api/v1/tposs/{tpos_id}/invoices/{payment_hash}", status_code=HTTPStatus.OK
+    "/api/v1/tposs/{tpos_id}/invoices/{payment_hash}",
+    status_code=HTTPStatus.OK,
+    dependencies=[Depends(get_tpos_or_404)],
 )
-async def api_tpos_check_invoice(tpos_id: str, payment_hash: str):
-    tpos = await get_tpos(tpos_id)
-    if not tpos:
-        raise HTTPException(
-            status_code=HTTPStatus.NOT_FOUND, detail="TPoS does not exist."
-        )
+async def api_tpos_check_invoice(payment_hash: str):
     try:
         status = await api_payment(payment_hash)
 
@@ -280,19 +329,30 @@ async def api_tpos_check_invoice(tpos_id: str, payment_hash: str):
 )
 async def api_stop():
     for t in scheduled_tasks:
-        try:
-            t.cancel()
-        except Exception as ex:
-            logger.warning(ex)
+        t.cancel()
+    # wait for the tasks to observe the cancellation, CancelledError is not logged
+    for result in await asyncio.gather(*scheduled_tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.warning(result)
+
+    if _HTTP is not None:
+        await _HTTP.aclose()
 
     return {"success": True}
 
 
-@tpos_ext.get("/api/v1/rate/{currency}", status_code=HTTPStatus.OK)
-async def api_check_fiat_rate(currency):
+async def _rate(currency: str) -> Optional[float]:
+    rate = _fiat_rates.get(currency)
+    if rate is not None:
+        return rate
     try:
         rate = await get_fiat_rate_satoshis(currency)
     except AssertionError:
-        rate = None
+        return None
+    _fiat_rates.set(currency, rate)
+    return rate
+
 
-    return {"rate": rate}
+@tpos_ext.get("/api/v1/rate/{currency}", status_code=HTTPStatus.OK)
+async def api_check_fiat_rate(currency):
+    return {"rate": await _rate(currency)}